@@ -1,85 +1,252 @@
+import json
 import logging
+import os
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from datetime import datetime
-from json import dumps, loads
+from functools import lru_cache
+from io import BytesIO
+from itertools import islice
 from operator import itemgetter
-from time import sleep
-from typing import Callable, Iterable, Literal, Optional
+from random import uniform
+from typing import Callable, Iterable, Iterator, Literal, Optional, Union
 from uuid import uuid4
 
+import numpy as np
+import orjson
 import requests
 import tiktoken
-from config import SRC_LOG_LEVELS
-from openai import OpenAI
-from openai.types import EmbeddingCreateParams
+from config import (
+    RAG_EMBEDDING_OPENAI_BATCH_CONCURRENCY,
+    RAG_EMBEDDING_OPENAI_BATCH_EXACT_TOKENS,
+    SRC_LOG_LEVELS,
+    TIKTOKEN_CACHE_DIR,
+)
+from openai import APIConnectionError, APIStatusError, OpenAI, RateLimitError
 from openai.types.batch import Batch
 from openai.types.file_object import FileObject
-from tenacity import retry, stop_after_attempt, wait_exponential
+from requests.adapters import HTTPAdapter
+from tenacity import (
+    retry,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
 
 log = logging.getLogger(__name__)
 log.setLevel(SRC_LOG_LEVELS["RAG"])
-TEXT_LENGTH_THRESHOLD_FOR_BATCH_API: int = 500_000
+# Keep the downloaded BPE ranks in a persistent cache instead of a temporary directory
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+# Basic TPM for Tier 1, assuming one minute of batch processing at a time
+# The budget is split evenly between the batches that are processed concurrently
+TOKEN_LIMIT_PER_BATCH: int = 1_000_000
+ESTIMATED_TOKEN_LIMIT_RATIO: float = 0.9  # Safety margin when tokens are estimated
+TEXT_LENGTH_THRESHOLD_FOR_PARALLEL_REQUESTS: int = 500_000
+# Parallel requests are sent within seconds, so keep them inside the per-minute token budget,
+# at roughly 4 characters per token
+TEXT_LENGTH_THRESHOLD_FOR_BATCH_API: int = int(
+    TOKEN_LIMIT_PER_BATCH * 4 * ESTIMATED_TOKEN_LIMIT_RATIO
+)
+MAX_TEXTS_PER_SYNC_REQUEST: int = 1024
+MAX_TOKENS_PER_REQUEST: int = 300_000  # Total input limit of a single request
+MAX_CONCURRENT_SYNC_REQUESTS: int = 8
 MAX_CHUNK_SIZE_PER_REQUEST: int = 2048
 BATCH_REQUEST_COMPLETION_WINDOW: Literal["24h"] = "24h"
-TOKEN_LIMIT_PER_BATCH: int = (
-    1_000_000  # Basic TPM for Tier 1, assuming one batch is processed per minute
+BATCH_RETRIEVE_WAIT_INTERVAL: int = 2  # Doubled on every poll without a status change
+BATCH_RETRIEVE_MAX_WAIT_INTERVAL: int = 900
+BATCH_RETRIEVE_WAIT_JITTER: float = 1.0
+BATCH_LIST_LIMIT: int = 100
+# Consecutive transient polling errors before the pending batches are failed
+BATCH_POLL_MAX_FAILURES: int = 5
+BATCH_FINAL_STATUSES: frozenset[str] = frozenset(
+    ("completed", "failed", "expired", "cancelled")
 )
-BATCH_RETRIEVE_WAIT_INTERVAL: int = 60
+HTTP_POOL_SIZE: int = 16
 TENAICITY_RETRY_ATTEMPTS: int = 5
 TENAICITY_WAIT_MIN: int = 4
 TENAICITY_WAIT_MAX: int = 10
 TENAICITY_WAIT_MULTIPLIER: int = 1
 FALLBACK_ENCODING: str = "cl100k_base"
 FALLBACK_TOKEN_COUNTER: Callable[[str], int] = lambda text: len(text) // 4  # noqa: E731
+TOKENIZER_NUM_THREADS: int = os.cpu_count() or 1
+TOKENIZER_BATCH_SIZE: int = 4096  # Texts encoded at a time when counting tokens
+
+
+# Shared session, so that synchronous requests reuse keep-alive connections
+_SESSION: requests.Session = requests.Session()
+for _prefix in ("http://", "https://"):
+    _SESSION.mount(
+        _prefix,
+        HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE),
+    )
 
 
-def _print_with_time(msg: str) -> None:
-    log.info(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+def _print_with_time(msg: str, *args: object) -> None:
+    # The default log format has no timestamp, so prepend one, but only when it is logged
+    if log.isEnabledFor(logging.INFO):
+        log.info("[%s] " + msg, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), *args)
 
 
-def _get_token_count(model: str) -> Callable[[str], int]:
+def _get_poll_interval(wait_interval: int, attempt: int) -> float:
+    # Back off exponentially while the batches stay in the same status
+    # The jitter keeps concurrent batches from polling in lockstep
+    return min(
+        BATCH_RETRIEVE_MAX_WAIT_INTERVAL, wait_interval * 2 ** min(attempt, 10)
+    ) + uniform(0, BATCH_RETRIEVE_WAIT_JITTER)
+
+
+@lru_cache(maxsize=32)
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    # Resolve the tiktoken encoding for the model once per process
+    # Constructing an encoding loads the BPE ranks, which is too slow to repeat per call
+    # Failures are raised rather than returned, so that they are not cached
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def _get_token_count(model: str) -> Callable[[list[str]], list[int]]:
     # Get the token count function for the model, or a rough estimate if not available
+    # The returned function counts a list of texts a slice at a time, so that tiktoken can
+    # encode each slice in parallel outside of the GIL
     try:
-        func = tiktoken.encoding_for_model(model)
-        return FALLBACK_TOKEN_COUNTER
+        encoding: tiktoken.Encoding = _get_encoding(model)
     except Exception as e:
         log.exception(e)
+        return lambda texts: [FALLBACK_TOKEN_COUNTER(text) for text in texts]
 
-    try:
-        func: tiktoken.Encoding = tiktoken.get_encoding(FALLBACK_ENCODING)
-        return lambda text: len(func.encode(text))
+    def count_tokens(texts: list[str]) -> list[int]:
+        # Only the counts are needed, so skip the special token handling of `encode`
+        # The texts are encoded in slices, so that only one slice's tokens are held at a time
+        token_counts: list[int] = []
+        for start in range(0, len(texts), TOKENIZER_BATCH_SIZE):
+            token_counts.extend(
+                len(tokens)
+                for tokens in encoding.encode_ordinary_batch(
+                    texts[start : start + TOKENIZER_BATCH_SIZE],
+                    num_threads=TOKENIZER_NUM_THREADS,
+                )
+            )
+        return token_counts
+
+    return count_tokens
 
-    except Exception as e:
-        log.exception(e)
 
-    return lambda text: int(len(text) / 4)  # rough estimate
+def _custom_id_key(result: dict) -> tuple[int, int]:
+    # Sort key for batch results, parsed from the custom_id `batch_{uuid}_{batch_idx}_{request_idx}`
+    # The indices must be compared as integers, otherwise `_10` would sort before `_2`
+    _, batch_idx, request_idx = result["custom_id"].rsplit("_", 2)
+    return int(batch_idx), int(request_idx)
 
 
-def _texts_iterator(lst: list[str], chunk_size: int) -> Iterable[tuple[int, list[str]]]:
-    # Yield chunks of texts, along with the index of the first text in the chunk
+def _estimate_token_count(texts: list[str]) -> np.ndarray:
+    # Estimate the token counts as one token per four characters, rounded up
+    # The token limit per batch is a soft rate limit, so this is accurate enough
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    return (lengths + 3) // 4
+
+
+def _split_by_tokens(
+    token_counts: np.ndarray, max_tokens: int, max_texts: Optional[int] = None
+) -> Iterable[tuple[int, int]]:
+    # Yield the (start, end) ranges of consecutive texts that fit within the limits
+    # Each range end is found by a binary search over the cumulative token counts,
+    # so the loop runs once per range instead of once per text
+    # A single text over the token limit still gets a range of its own
+    cumulative_tokens: np.ndarray = np.cumsum(token_counts)
+    start: int = 0
+    while start < len(cumulative_tokens):
+        offset: int = int(cumulative_tokens[start - 1]) if start else 0
+        end: int = int(
+            np.searchsorted(cumulative_tokens, offset + max_tokens, side="right")
+        )
+        if max_texts is not None:
+            end = min(end, start + max_texts)
+        end = max(end, start + 1)
+        yield start, end
+        start = end
+
+
+def _sub_batch_iterator(
+    texts: list[str], token_counts: np.ndarray, max_texts: int, max_tokens: int
+) -> Iterable[tuple[int, list[str]]]:
+    # Yield sub-batches of texts that fit in a single embedding request,
+    # along with the index of the first text in the sub-batch
     # This is used to keep track of the order of the embeddings
-    for i in range(0, len(lst), chunk_size):
-        yield i, lst[i : i + chunk_size]
+    for start, end in _split_by_tokens(token_counts, max_tokens, max_texts):
+        yield start, texts[start:end]
 
 
 def _request_iterator(
     texts: list[str],
+    token_counts: np.ndarray,
     model: str,
     uuid: str,
     batch_idx: int,
     chunk_size: int = MAX_CHUNK_SIZE_PER_REQUEST,
+    request_token_limit: int = MAX_TOKENS_PER_REQUEST,
 ) -> Iterable[bytes]:
     # Yield individual requests for a chunk of texts
     # Each request is a JSON-encoded dictionary with the custom_id, method, url, and body
     # The custom_id is used to order the embeddings
-    for request_idx, texts in _texts_iterator(texts, chunk_size):
-        yield (
-            dumps({
-                "custom_id": f"batch_{uuid}_{batch_idx}_{request_idx}",
-                "method": "POST",
-                "url": "/v1/embeddings",
-                "body": EmbeddingCreateParams(model=model, input=texts),
-            }).encode()
+    # Texts are packed into a request until either its text or token limit is reached
+    custom_id_prefix: str = f"batch_{uuid}_{batch_idx}_"
+    for request_idx, texts in _sub_batch_iterator(
+        texts, token_counts, chunk_size, request_token_limit
+    ):
+        request: dict = {
+            "custom_id": custom_id_prefix + str(request_idx),
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {"model": model, "input": texts},
+        }
+        line: bytes
+        try:
+            line = orjson.dumps(request)
+        except orjson.JSONEncodeError:
+            # orjson rejects lone surrogates, which extracted PDF text may contain
+            # The standard library escapes them, just like the synchronous requests do
+            line = json.dumps(request).encode()
+        yield line
+
+
+def _write_batch_file(
+    texts: list[str],
+    token_counts: np.ndarray,
+    model: str,
+    uuid: str,
+    batch_idx: int,
+    chunk_size: int = MAX_CHUNK_SIZE_PER_REQUEST,
+    request_token_limit: int = MAX_TOKENS_PER_REQUEST,
+) -> BytesIO:
+    # Write the requests of a batch as JSONL into a file-like buffer
+    # The requests are written one by one, so the whole batch never exists twice in memory
+    # A batch is bounded by the token limit to a few megabytes, so it stays in memory,
+    # and the upload reads it in chunks without copying the whole buffer
+    batch_file = BytesIO()
+    for request_idx, request in enumerate(
+        _request_iterator(
+            texts,
+            token_counts,
+            model,
+            uuid,
+            batch_idx,
+            chunk_size,
+            request_token_limit,
         )
+    ):
+        if request_idx:
+            batch_file.write(b"\n")
+        batch_file.write(request)
+    batch_file.seek(0)
+    return batch_file
 
 
 def _batch_iterator(
@@ -88,37 +255,178 @@ def _batch_iterator(
     uuid: str,
     token_limit: int,
     chunk_size: int = MAX_CHUNK_SIZE_PER_REQUEST,
-) -> Iterable[tuple[int, bytes]]:
-    current_request: list[str] = []
-    current_tokens = 0
-    batch_idx: int = 0
-    text2tokens: Callable[[str], int] = _get_token_count(model)
-    for text in texts:
-        tokens: int = text2tokens(text)
-        if current_tokens + tokens > token_limit:
-            yield (
-                batch_idx,
-                b"\n".join(
-                    _request_iterator(
-                        current_request, model, uuid, batch_idx, chunk_size
-                    )
-                ),
-            )
-            batch_idx += 1
-            current_request = [text]
-            current_tokens = tokens
-        else:
-            current_request.append(text)
-            current_tokens += tokens
-    if current_request:
+    exact_tokens: bool = False,
+) -> Iterable[tuple[int, BytesIO]]:
+    request_token_limit: int = MAX_TOKENS_PER_REQUEST
+    text2tokens: Callable[[list[str]], Union[list[int], np.ndarray]]
+    if exact_tokens:
+        text2tokens = _get_token_count(model)
+    else:
+        text2tokens = _estimate_token_count
+        token_limit = int(token_limit * ESTIMATED_TOKEN_LIMIT_RATIO)
+        request_token_limit = int(request_token_limit * ESTIMATED_TOKEN_LIMIT_RATIO)
+    token_counts: np.ndarray = np.asarray(text2tokens(texts), dtype=np.int64)
+    for batch_idx, (start, end) in enumerate(
+        _split_by_tokens(token_counts, token_limit)
+    ):
         yield (
             batch_idx,
-            b"\n".join(
-                _request_iterator(current_request, model, uuid, batch_idx, chunk_size)
+            _write_batch_file(
+                texts[start:end],
+                token_counts[start:end],
+                model,
+                uuid,
+                batch_idx,
+                chunk_size,
+                request_token_limit,
             ),
         )
 
 
+class _BatchCancelledError(RuntimeError):
+    # Raised in the batch workers once the embedding job has been given up on
+    pass
+
+
+def _cancel_batch(client: OpenAI, batch_id: str) -> None:
+    # Best effort, so that an abandoned batch job doesn't keep running and get billed
+    try:
+        client.batches.cancel(batch_id)
+        log.info("Cancelled batch job %s", batch_id)
+    except Exception as e:
+        log.warning("Failed to cancel batch job %s: %s", batch_id, e)
+
+
+def _is_transient_error(e: Exception) -> bool:
+    # Connection errors (including timeouts) and server errors are worth retrying
+    if isinstance(e, APIConnectionError):
+        return True
+    return isinstance(e, APIStatusError) and e.status_code >= 500
+
+
+class _BatchPoller:
+    # Poll the status of all in-flight batch jobs of a client from a single background thread
+    # One `batches.list` call per interval serves every batch, instead of one retrieve per batch
+    # Batches not on the first listed page are retrieved individually
+
+    def __init__(self, client: OpenAI, wait_interval: int) -> None:
+        self._client: OpenAI = client
+        self._wait_interval: int = wait_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._events: dict[str, threading.Event] = {}
+        self._results: dict[str, Union[Batch, Exception]] = {}
+        self._statuses: dict[str, str] = {}
+        self._closed: bool = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self) -> None:
+        # Stop polling, and release every waiting batch with a cancellation error
+        with self._lock:
+            self._closed = True
+            events: dict[str, threading.Event] = self._events
+            self._events = {}
+            for batch_id, event in events.items():
+                self._results[batch_id] = _BatchCancelledError(
+                    f"Batch Job Cancelled: {batch_id}"
+                )
+                event.set()
+        self._wakeup.set()
+
+    def wait(self, batch_id: str) -> Batch:
+        # Block until the batch job reaches a final status, and return it
+        event = threading.Event()
+        with self._lock:
+            if self._closed:
+                raise _BatchCancelledError(f"Batch Job Cancelled: {batch_id}")
+            self._events[batch_id] = event
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup.set()  # Poll the new batch without waiting out the current interval
+        event.wait()
+
+        with self._lock:
+            result: Union[Batch, Exception] = self._results.pop(batch_id)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _run(self) -> None:
+        attempt: int = 0
+        failures: int = 0  # Consecutive polls that failed with a transient error
+        while True:
+            with self._lock:
+                pending: set[str] = set(self._events)
+                if not pending:
+                    self._thread = None
+                    return
+
+            try:
+                changed: bool = self._poll(pending)
+                failures = 0
+            except RateLimitError as e:
+                # Polling is not worth failing the batches over, so just back off
+                log.warning("Rate limited while retrieving batch status: %s", e)
+                changed = False
+            except Exception as e:
+                # Connection errors and server errors are likely to go away, so back off too
+                # The batches only fail if they keep happening, or if the error is not retryable
+                failures += 1
+                if not _is_transient_error(e) or failures >= BATCH_POLL_MAX_FAILURES:
+                    for batch_id in pending:
+                        self._finish(batch_id, e)
+                    failures = 0
+                    continue
+                log.warning(
+                    "Failed to retrieve batch status (%d/%d): %s",
+                    failures,
+                    BATCH_POLL_MAX_FAILURES,
+                    e,
+                )
+                changed = False
+
+            attempt = 0 if changed else attempt + 1
+            if self._wakeup.wait(_get_poll_interval(self._wait_interval, attempt)):
+                self._wakeup.clear()
+                attempt = 0
+
+    def _poll(self, pending: set[str]) -> bool:
+        # Update the status of the pending batches, returning whether any of them changed
+        batches: dict[str, Batch] = {
+            batch.id: batch
+            for batch in self._client.batches.list(limit=BATCH_LIST_LIMIT).data
+        }
+        for batch_id in pending - batches.keys():
+            batches[batch_id] = self._client.batches.retrieve(batch_id)
+
+        changed: bool = False
+        for batch_id in pending:
+            batch: Batch = batches[batch_id]
+            if self._statuses.get(batch_id) != batch.status:
+                changed = True
+                self._statuses[batch_id] = batch.status
+                _print_with_time(
+                    "Batch Request Status (%s): %s", batch_id, batch.status
+                )
+            if batch.status in BATCH_FINAL_STATUSES:
+                self._finish(batch_id, batch)
+        return changed
+
+    def _finish(self, batch_id: str, result: Union[Batch, Exception]) -> None:
+        with self._lock:
+            event: Optional[threading.Event] = self._events.pop(batch_id, None)
+            if event is None:
+                return
+            self._statuses.pop(batch_id, None)
+            self._results[batch_id] = result
+            event.set()
+
+
 @retry(
     stop=stop_after_attempt(TENAICITY_RETRY_ATTEMPTS),
     wait=wait_exponential(
@@ -126,64 +434,75 @@ def _batch_iterator(
         min=TENAICITY_WAIT_MIN,
         max=TENAICITY_WAIT_MAX,
     ),
+    retry=retry_if_not_exception_type(_BatchCancelledError),
 )
 def _process_one_batch(
     client: OpenAI,
     uuid: str,
     batch_idx: int,
-    batch: bytes,
+    batch: BytesIO,
     completion_window: Literal["24h"],
-    wait_interval: int,
+    poller: _BatchPoller,
 ) -> list[list[float]]:
     # Process a single batch of requests
     # This function creates a batch job, waits for it to complete, and returns the embeddings
     # The embeddings are sorted by the custom_id, which includes the batch index and request index
     # This ensures that the embeddings are returned in the same order as the input texts
+    # A batch job that is given up on before it finishes is cancelled
+    batch_job: Optional[Batch] = None
+    finished: bool = False
     try:
+        if poller.closed:
+            raise _BatchCancelledError(f"Batch Job Cancelled: {batch_idx}")
+        batch.seek(0)  # Rewind the batch file in case of a retry
         input_file: FileObject = client.files.create(
             file=(f"batch_{uuid}_{batch_idx}.jsonl", batch), purpose="batch"
         )
-        batch_job: Batch = client.batches.create(
+        if poller.closed:
+            raise _BatchCancelledError(f"Batch Job Cancelled: {batch_idx}")
+        batch_job = client.batches.create(
             input_file_id=input_file.id,
             endpoint="/v1/embeddings",
             completion_window=completion_window,
         )
-        while True:
-            batch_status: Batch = client.batches.retrieve(batch_job.id)
-            status: Literal[
-                "validating",
-                "failed",
-                "in_progress",
-                "finalizing",
-                "completed",
-                "expired",
-                "cancelling",
-                "cancelled",
-            ] = batch_status.status
-            output_file_id = batch_status.output_file_id
-
-            if output_file_id and status == "completed":
-                log.info("Batch Job Completed")
-                output_content: str = client.files.content(output_file_id).text
-                raw_results = map(loads, output_content.strip().split("\n"))
-                sorted_results = sorted(raw_results, key=itemgetter("custom_id"))
-                return [
-                    data["embedding"]
-                    for result in sorted_results
-                    for data in result["response"]["body"]["data"]
-                ]
-
-            elif status in ("failed", "expired", "cancelled"):
-                raise RuntimeError(f"Batch Job Failed: {status}")
-
-            _print_with_time(f"Batch Request Status: {status}")
-            sleep(wait_interval)
+        batch_status: Batch = poller.wait(batch_job.id)
+        finished = True
+        status: Literal[
+            "validating",
+            "failed",
+            "in_progress",
+            "finalizing",
+            "completed",
+            "expired",
+            "cancelling",
+            "cancelled",
+        ] = batch_status.status
+        output_file_id = batch_status.output_file_id
+
+        if not (output_file_id and status == "completed"):
+            raise RuntimeError(f"Batch Job Failed: {status}")
+
+        log.info("Batch Job Completed")
+        # Stream the output file line by line instead of loading it as a single string
+        results: list[tuple[tuple[int, int], list[dict]]] = []
+        with client.files.with_streaming_response.content(output_file_id) as response:
+            for line in response.iter_lines():
+                if line:
+                    result: dict = orjson.loads(line)
+                    results.append(
+                        (_custom_id_key(result), result["response"]["body"]["data"])
+                    )
+        results.sort(key=itemgetter(0))
+        return [data["embedding"] for _, datas in results for data in datas]
     except Exception as e:
-        log.exception(e)
+        if not isinstance(e, _BatchCancelledError):
+            log.exception(e)
+        if batch_job is not None and not finished:
+            _cancel_batch(client, batch_job.id)
         raise
 
 
-def _request_async_embedding(
+def _iter_async_embeddings(
     model: str,
     texts: list[str],
     key: str,
@@ -191,16 +510,84 @@ def _request_async_embedding(
     completion_window: Literal["24h"],
     wait_interval: int,
     token_limit: int,
-) -> list[list[float]]:
+    exact_tokens: bool = False,
+    max_concurrent_batches: int = 1,
+) -> Iterator[list[float]]:
+    # Yield the embeddings in the order of the texts, as soon as their batch is done
+    # This lets the caller start storing embeddings before the last batch completes
+    # The token limit is the budget for all in-flight batches, so it is split between them
+    if not isinstance(model, str) or not model:
+        raise ValueError(f"Invalid embedding model: {model!r}")
+
     uuid: str = uuid4().hex
     client: OpenAI = OpenAI(api_key=key, base_url=url)
-    return [
-        embedding
-        for batch_idx, batch in _batch_iterator(texts, model, uuid, token_limit)
-        for embedding in _process_one_batch(
-            client, uuid, batch_idx, batch, completion_window, wait_interval
+    batches: Iterator[tuple[int, BytesIO]] = _batch_iterator(
+        texts,
+        model,
+        uuid,
+        token_limit // max_concurrent_batches,
+        exact_tokens=exact_tokens,
+    )
+    poller = _BatchPoller(client, wait_interval)
+
+    def process_and_close(batch_idx: int, batch: BytesIO) -> list[list[float]]:
+        with batch:
+            return _process_one_batch(
+                client, uuid, batch_idx, batch, completion_window, poller
+            )
+
+    # The batches are independent and mostly spent waiting, so process them concurrently
+    # Only as many batch files as there are workers are built and held in memory at a time
+    # The results are keyed by the batch index, and held back until every earlier batch is yielded
+    results: dict[int, list[list[float]]] = {}
+    next_batch_idx: int = 0
+    futures: dict[Future[list[list[float]]], int] = {}
+    executor = ThreadPoolExecutor(max_workers=max_concurrent_batches)
+    try:
+        for batch_idx, batch in islice(batches, max_concurrent_batches):
+            futures[executor.submit(process_and_close, batch_idx, batch)] = batch_idx
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[futures.pop(future)] = future.result()
+            for batch_idx, batch in islice(batches, len(done)):
+                futures[executor.submit(process_and_close, batch_idx, batch)] = (
+                    batch_idx
+                )
+            while next_batch_idx in results:
+                yield from results.pop(next_batch_idx)
+                next_batch_idx += 1
+    finally:
+        # If a batch has failed, or the caller stopped early, give up on the other batches
+        # Their workers cancel the batch jobs they have created, and return
+        poller.close()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _request_async_embedding(
+    model: str,
+    texts: list[str],
+    key: str,
+    url: str,
+    completion_window: Literal["24h"],
+    wait_interval: int,
+    token_limit: int,
+    exact_tokens: bool = False,
+    max_concurrent_batches: int = 1,
+) -> list[list[float]]:
+    return list(
+        _iter_async_embeddings(
+            model,
+            texts,
+            key,
+            url,
+            completion_window,
+            wait_interval,
+            token_limit,
+            exact_tokens,
+            max_concurrent_batches,
         )
-    ]
+    )
 
 
 @retry(
@@ -212,8 +599,7 @@ def _request_async_embedding(
     ),
 )
 def _request_sync_embedding(url, key, texts, model):
-    log.info("Using single processing for OpenAI embeddings")
-    r = requests.post(
+    r = _SESSION.post(
         f"{url}/embeddings",
         headers={
             "Content-Type": "application/json",
@@ -230,17 +616,76 @@ def _request_sync_embedding(url, key, texts, model):
         raise Exception("Something went wrong :/")
 
 
+def _request_parallel_sync_embedding(
+    url: str,
+    key: str,
+    texts: list[str],
+    model: str,
+    max_workers: int = MAX_CONCURRENT_SYNC_REQUESTS,
+    sub_batch: int = MAX_TEXTS_PER_SYNC_REQUEST,
+    exact_tokens: bool = False,
+) -> list[list[float]]:
+    # Split the texts into sub-batches and request their embeddings concurrently
+    # The embeddings are written back at the index of the first text of each sub-batch
+    # Like the batch files, estimated token counts keep a margin below the request limit
+    request_token_limit: int = MAX_TOKENS_PER_REQUEST
+    token_counts: np.ndarray
+    if exact_tokens:
+        token_counts = np.asarray(_get_token_count(model)(texts), dtype=np.int64)
+    else:
+        token_counts = _estimate_token_count(texts)
+        request_token_limit = int(request_token_limit * ESTIMATED_TOKEN_LIMIT_RATIO)
+    embeddings: list[list[float]] = [[] for _ in texts]
+    sub_batches: Iterable[tuple[int, list[str]]] = _sub_batch_iterator(
+        texts, token_counts, sub_batch, request_token_limit
+    )
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures: dict[Future[list[list[float]]], tuple[int, int]] = {
+            executor.submit(_request_sync_embedding, url, key, chunk, model): (
+                start,
+                len(chunk),
+            )
+            for start, chunk in sub_batches
+        }
+        for future in as_completed(futures):
+            start, size = futures[future]
+            result: list[list[float]] = future.result()
+            if len(result) != size:
+                # A short or long result would shift every embedding after it
+                raise RuntimeError(
+                    f"Expected {size} embeddings for texts {start}-{start + size}, "
+                    f"got {len(result)}"
+                )
+            embeddings[start : start + size] = result
+    finally:
+        # If a sub-batch has failed, don't send the sub-batches still in the queue
+        executor.shutdown(wait=True, cancel_futures=True)
+    return embeddings
+
+
 def generate_openai_batch_embeddings(
     model: str, texts: list[str], key: str, url: str = "https://api.openai.com/v1"
 ) -> Optional[list[list[float]]]:
     try:
         text_length: int = sum((len(text) for text in texts))
         log.info(
-            f"len(texts): {len(texts)} / sum(len(text) for text in texts): {text_length}"
+            "len(texts): %d / sum(len(text) for text in texts): %d",
+            len(texts),
+            text_length,
         )
-        if text_length < TEXT_LENGTH_THRESHOLD_FOR_BATCH_API:
+        if text_length < TEXT_LENGTH_THRESHOLD_FOR_PARALLEL_REQUESTS:
             log.info("Using single processing for OpenAI embeddings")
             return _request_sync_embedding(url, key, texts, model)
+        elif text_length < TEXT_LENGTH_THRESHOLD_FOR_BATCH_API:
+            log.info("Using parallel processing for OpenAI embeddings")
+            return _request_parallel_sync_embedding(
+                url,
+                key,
+                texts,
+                model,
+                exact_tokens=RAG_EMBEDDING_OPENAI_BATCH_EXACT_TOKENS,
+            )
         else:
             log.info("Using batch processing for OpenAI embeddings")
             return _request_async_embedding(
@@ -251,6 +696,8 @@ def generate_openai_batch_embeddings(
                 BATCH_REQUEST_COMPLETION_WINDOW,
                 BATCH_RETRIEVE_WAIT_INTERVAL,
                 TOKEN_LIMIT_PER_BATCH,
+                RAG_EMBEDDING_OPENAI_BATCH_EXACT_TOKENS,
+                RAG_EMBEDDING_OPENAI_BATCH_CONCURRENCY,
             )
 
     except Exception as e:
@@ -1056,6 +1056,16 @@ RAG_EMBEDDING_OPENAI_BATCH_SIZE = PersistentConfig(
     os.environ.get("RAG_EMBEDDING_OPENAI_BATCH_SIZE", 1),
 )
 
+RAG_EMBEDDING_OPENAI_BATCH_EXACT_TOKENS = (
+    os.environ.get("RAG_EMBEDDING_OPENAI_BATCH_EXACT_TOKENS", "").lower() == "true"
+)
+
+RAG_EMBEDDING_OPENAI_BATCH_CONCURRENCY = max(
+    int(os.environ.get("RAG_EMBEDDING_OPENAI_BATCH_CONCURRENCY", "1")), 1
+)
+
+TIKTOKEN_CACHE_DIR = os.getenv("TIKTOKEN_CACHE_DIR", f"{CACHE_DIR}/tiktoken")
+
 RAG_RERANKING_MODEL = PersistentConfig(
     "RAG_RERANKING_MODEL",
     "rag.reranking_model",
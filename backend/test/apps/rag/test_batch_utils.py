@@ -1,20 +1,40 @@
 import json
+import threading
 from dataclasses import dataclass
-from typing import Callable, Dict, List, Literal, NamedTuple, Optional, Self, TypedDict
+from typing import (
+    IO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Self,
+    Set,
+    TypedDict,
+)
 from unittest.mock import MagicMock, patch
 
+import numpy as np
+import pytest
+
 # Test module name and function names
 module_name: str = "apps.rag.batch_utils"
 sync_function_name: str = "_request_sync_embedding"
 async_function_name: str = "_request_async_embedding"
 token_counter_function_name: str = "_get_token_count"
+exact_tokens_config_name: str = "RAG_EMBEDDING_OPENAI_BATCH_EXACT_TOKENS"
+batch_api_threshold_name: str = "TEXT_LENGTH_THRESHOLD_FOR_BATCH_API"
 EXPECTED_EMBEDDING_DIMENSION: int = 1536
 FAKE_EMBEDDING: Dict[Literal["embedding"], List[float]] = {
     "embedding": [0.0] * EXPECTED_EMBEDDING_DIMENSION
 }
 NUM_TEXTS: int = 16384
 NUM_TOKENS: int = 1_000_000
-FAKE_TOKENIZER: Callable[[str], int] = lambda x: len(x) // 4  # noqa: E731
+FAKE_TOKENIZER: Callable[[List[str]], List[int]] = lambda x: [  # noqa: E731
+    len(text) // 4 for text in x
+]
 TEXT_LENGTH: int = (NUM_TOKENS * 4) // NUM_TEXTS + 1
 
 
@@ -42,6 +62,15 @@ class MockHTTPResponse(NamedTuple):
     status_code: int
     text: str
 
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def iter_lines(self) -> Iterator[str]:
+        return iter(self.text.splitlines())
+
 
 @dataclass
 class MockBatch:
@@ -94,19 +123,22 @@ class MockOpenAIClient:
     def files(self) -> Self:
         self.create = MagicMock(side_effect=self.files_create)
         self.content = MagicMock(side_effect=self.files_content)
+        self.with_streaming_response = self
         return self
 
     @property
     def batches(self) -> Self:
         self.create = MagicMock(side_effect=self.batches_create)
         self.retrieve = MagicMock(side_effect=self.batches_retrieve)
+        self.list = MagicMock(side_effect=self.batches_list)
         return self
 
     def files_create(
-        self, file: tuple[str, bytes], purpose: Literal["batch"]
+        self, file: tuple[str, IO[bytes]], purpose: Literal["batch"]
     ) -> MockFileObject:
         # Simulate creating a file object
-        file_name, file_bytes = file
+        file_name, file_obj = file
+        file_bytes: bytes = file_obj.read()
         assert purpose == "batch", f"Expected purpose 'batch', got '{purpose}'"
         mock_file_object = MockFileObject(
             id=f"mock_file_id_{len(self.mock_requests)}",
@@ -160,6 +192,13 @@ class MockOpenAIClient:
         ]
         return mock_batch
 
+    def batches_list(self, limit: int) -> MagicMock:
+        # Simulate listing the most recent batch jobs
+        batch_ids: List[str] = list(self.mock_batches)[-limit:]
+        return MagicMock(
+            data=[self.batches_retrieve(batch_id) for batch_id in batch_ids]
+        )
+
     def files_content(self, output_file_id: str) -> MockHTTPResponse:
         # Simulate retrieving the content of a file
         responses: List[MockBatchResponse] = self.mock_responses[output_file_id]
@@ -168,6 +207,102 @@ class MockOpenAIClient:
         )
 
 
+class MockOutOfOrderBatchClient:
+    """A thread-safe batch client that completes the most recently created batch first.
+
+    Every text is embedded as its own index, so that the order can be checked.
+    If `failed_batch_indices` is given, those batches fail and the others never finish.
+    """
+
+    def __init__(self, failed_batch_indices: Optional[Set[int]] = None) -> None:
+        self.failed_batch_indices: Optional[Set[int]] = failed_batch_indices
+        self.mock_batches: Dict[str, MockBatch] = {}
+        self.mock_files: Dict[str, List[MockBatchRequest]] = {}
+        self.mock_responses: Dict[str, List[MockBatchResponse]] = {}
+        self.lock = threading.Lock()
+        self.files = MagicMock()
+        self.files.create.side_effect = self.files_create
+        self.files.with_streaming_response.content.side_effect = self.files_content
+        self.batches = MagicMock()
+        self.batches.create.side_effect = self.batches_create
+        self.batches.retrieve.side_effect = self.mock_batches.__getitem__
+        self.batches.list.side_effect = self.batches_list
+        self.batches.cancel.side_effect = self.batches_cancel
+
+    def files_create(
+        self, file: tuple[str, IO[bytes]], purpose: Literal["batch"]
+    ) -> MagicMock:
+        with self.lock:
+            file_id: str = f"mock_file_id_{len(self.mock_files)}"
+            self.mock_files[file_id] = list(
+                map(json.loads, file[1].read().split(b"\n"))
+            )
+        return MagicMock(id=file_id)
+
+    def batches_create(
+        self, input_file_id: str, endpoint: str, completion_window: str
+    ) -> MockBatch:
+        with self.lock:
+            mock_batch = MockBatch(
+                id=f"mock_batch_id_{len(self.mock_batches)}",
+                input_file_id=input_file_id,
+                status="in_progress",
+                output_file_id=None,
+            )
+            self.mock_batches[mock_batch.id] = mock_batch
+        return mock_batch
+
+    def batches_list(self, limit: int) -> MagicMock:
+        with self.lock:
+            pending: List[MockBatch] = [
+                mock_batch
+                for mock_batch in reversed(self.mock_batches.values())
+                if mock_batch.status == "in_progress"
+            ]
+            if self.failed_batch_indices is not None:
+                for mock_batch in pending:
+                    if self.batch_idx(mock_batch) in self.failed_batch_indices:
+                        mock_batch.status = "failed"
+            elif pending:
+                self.complete(pending[0])
+            return MagicMock(data=list(self.mock_batches.values())[-limit:])
+
+    def batches_cancel(self, batch_id: str) -> MockBatch:
+        with self.lock:
+            self.mock_batches[batch_id].status = "cancelled"
+            return self.mock_batches[batch_id]
+
+    def batch_idx(self, mock_batch: MockBatch) -> int:
+        request: MockBatchRequest = self.mock_files[mock_batch.input_file_id][0]
+        return int(request["custom_id"].rsplit("_", 2)[1])
+
+    def complete(self, mock_batch: MockBatch) -> None:
+        requests: List[MockBatchRequest] = self.mock_files[mock_batch.input_file_id]
+        mock_batch.status = "completed"
+        mock_batch.output_file_id = f"mock_output_file_id_{mock_batch.id}"
+        self.mock_responses[mock_batch.output_file_id] = [
+            {
+                "custom_id": request["custom_id"],
+                "response": {
+                    "body": {
+                        "data": [
+                            {"embedding": [float(text)]}
+                            for text in request["body"]["input"]
+                        ]
+                    }
+                },
+            }
+            # Shuffle the requests of the output file as well
+            for request in reversed(requests)
+        ]
+
+    def files_content(self, output_file_id: str) -> MockHTTPResponse:
+        responses: List[MockBatchResponse] = self.mock_responses[output_file_id]
+        return MockHTTPResponse(
+            status_code=200, text="\n".join(json.dumps(result) for result in responses)
+        )
+
+
 def test_generate_openai_batch_embeddings_flow() -> None:
     """Test the flow of generate_openai_batch_embeddings function.
 
@@ -183,9 +318,12 @@ def test_generate_openai_batch_embeddings_flow() -> None:
     mock_url: str = "https://batch.mock.test/v1"
     texts: List[str] = ["A" * TEXT_LENGTH for _ in range(NUM_TEXTS)]
 
-    with patch(
-        f"{module_name}.{token_counter_function_name}"
-    ) as mock_token_counter, patch(f"{module_name}.OpenAI") as mock_openai_client:
+    with (
+        patch(f"{module_name}.{token_counter_function_name}") as mock_token_counter,
+        patch(f"{module_name}.OpenAI") as mock_openai_client,
+        patch(f"{module_name}.{exact_tokens_config_name}", True),
+        patch(f"{module_name}.{batch_api_threshold_name}", 0),
+    ):
         # Set up mock token counter, roughly 1/4 of the text length
         mock_token_counter.return_value = FAKE_TOKENIZER
 
@@ -213,3 +351,339 @@ def test_generate_openai_batch_embeddings_flow() -> None:
                 len(embedding) == EXPECTED_EMBEDDING_DIMENSION
             ), f"Embedding dimension mismatch: {len(embedding)} != {EXPECTED_EMBEDDING_DIMENSION}"
             assert all(value == 0.0 for value in embedding), "Embedding values mismatch"
+
+
+def test_parallel_sync_embeddings_keep_order() -> None:
+    """Test that parallel synchronous requests return embeddings in input order."""
+    from apps.rag.batch_utils import _request_parallel_sync_embedding
+
+    def mock_post(url: str, headers: Dict[str, str], json: Dict) -> MagicMock:
+        # Embed each text as its own index, so that the order can be checked
+        response = MagicMock()
+        response.json.return_value = {
+            "data": [{"embedding": [float(text)]} for text in json["input"]]
+        }
+        return response
+
+    texts: List[str] = [str(idx) for idx in range(NUM_TEXTS)]
+    with patch(f"{module_name}._SESSION") as mock_session:
+        mock_session.post.side_effect = mock_post
+        result: List[List[float]] = _request_parallel_sync_embedding(
+            "https://sync.mock.test/v1", "mock_api_key", texts, "mock-model"
+        )
+
+    assert result == [[float(text)] for text in texts], "Embeddings out of order"
+
+
+def test_parallel_sync_embeddings_reject_short_results() -> None:
+    """Test that a sub-batch returning too few embeddings fails instead of shifting the rest."""
+    from apps.rag.batch_utils import _request_parallel_sync_embedding
+
+    response = MagicMock()
+    response.json.return_value = {"data": [{"embedding": [0.0]}]}
+    texts: List[str] = ["text"] * 4
+    with patch(f"{module_name}._SESSION") as mock_session:
+        mock_session.post.return_value = response
+        with pytest.raises(RuntimeError, match="Expected 2 embeddings"):
+            _request_parallel_sync_embedding(
+                "https://sync.mock.test/v1",
+                "mock_api_key",
+                texts,
+                "mock-model",
+                sub_batch=2,
+            )
+
+
+def test_parallel_sync_embeddings_stop_after_failure() -> None:
+    """Test that a failed sub-batch stops the sub-batches still in the queue."""
+    from tenacity import RetryError, wait_fixed
+
+    from apps.rag.batch_utils import (
+        TENAICITY_RETRY_ATTEMPTS,
+        _request_parallel_sync_embedding,
+        _request_sync_embedding,
+    )
+
+    max_workers: int = 2
+    texts: List[str] = [str(idx) for idx in range(100)]
+    with (
+        patch(f"{module_name}._SESSION") as mock_session,
+        # Keep each failing sub-batch busy for longer than it takes to stop the others
+        patch.object(_request_sync_embedding.retry, "wait", wait_fixed(0.01)),
+        pytest.raises(RetryError),
+    ):
+        mock_session.post.side_effect = ConnectionError("Request failed")
+        _request_parallel_sync_embedding(
+            "https://sync.mock.test/v1",
+            "mock_api_key",
+            texts,
+            "mock-model",
+            max_workers=max_workers,
+            sub_batch=1,
+        )
+
+    # Only the sub-batches already taken by a worker are sent, instead of all 100
+    assert mock_session.post.call_count <= TENAICITY_RETRY_ATTEMPTS * 2 * max_workers
+
+
+def test_custom_id_key_sorts_numerically() -> None:
+    """Test that batch results are ordered by their numeric batch and request indices."""
+    from apps.rag.batch_utils import _custom_id_key
+
+    results: List[Dict[str, str]] = [
+        {"custom_id": "batch_uuid_1_0"},
+        {"custom_id": "batch_uuid_0_10"},
+        {"custom_id": "batch_uuid_0_2"},
+    ]
+    assert [result["custom_id"] for result in sorted(results, key=_custom_id_key)] == [
+        "batch_uuid_0_2",
+        "batch_uuid_0_10",
+        "batch_uuid_1_0",
+    ]
+
+
+def test_encoding_failures_are_not_cached() -> None:
+    """Test that a failed encoding load falls back once, and is retried on the next call."""
+    from apps.rag.batch_utils import _get_encoding, _get_token_count
+
+    mock_encoding = MagicMock()
+    mock_encoding.encode_ordinary_batch.return_value = [[0, 1, 2]]
+    _get_encoding.cache_clear()
+    with patch(
+        f"{module_name}.tiktoken.encoding_for_model",
+        side_effect=[ConnectionError("BPE download failed"), mock_encoding],
+    ):
+        assert _get_token_count("mock-model")(["text"]) == [1], "Expected the estimate"
+        assert _get_token_count("mock-model")(["text"]) == [3], "Expected exact counts"
+    _get_encoding.cache_clear()
+
+
+def test_token_count_encodes_in_slices() -> None:
+    """Test that exact token counts are computed a slice of texts at a time."""
+    from apps.rag.batch_utils import _get_encoding, _get_token_count
+
+    mock_encoding = MagicMock()
+    mock_encoding.encode_ordinary_batch.side_effect = lambda texts, num_threads: [
+        [0] * len(text) for text in texts
+    ]
+    texts: List[str] = ["A" * (idx % 7) for idx in range(10)]
+    _get_encoding.cache_clear()
+    with (
+        patch(f"{module_name}.tiktoken.encoding_for_model", return_value=mock_encoding),
+        patch(f"{module_name}.TOKENIZER_BATCH_SIZE", 4),
+    ):
+        assert _get_token_count("mock-model")(texts) == [len(text) for text in texts]
+    _get_encoding.cache_clear()
+
+    assert [
+        len(call.args[0]) for call in mock_encoding.encode_ordinary_batch.call_args_list
+    ] == [4, 4, 2], "Expected the texts to be encoded in slices"
+
+
+def test_estimated_batches_stay_under_scaled_limit() -> None:
+    """Test the default token estimate, and that batches keep its safety margin."""
+    from apps.rag.batch_utils import (
+        ESTIMATED_TOKEN_LIMIT_RATIO,
+        _batch_iterator,
+        _estimate_token_count,
+    )
+
+    assert list(_estimate_token_count(["", "a", "abcd", "abcde", "a" * 9])) == [
+        0,
+        1,
+        1,
+        2,
+        3,
+    ], "Expected ceil(len / 4)"
+
+    token_limit: int = 1000
+    texts: List[str] = ["A" * (idx % 97 + 1) for idx in range(NUM_TEXTS // 16)]
+    batched_texts: List[str] = []
+    for _, batch_file in _batch_iterator(texts, "mock-model", "uuid", token_limit):
+        batch_texts: List[str] = [
+            text
+            for line in batch_file.read().split(b"\n")
+            for text in json.loads(line)["body"]["input"]
+        ]
+        batch_tokens: int = sum(_estimate_token_count(batch_texts))
+        assert batch_tokens <= int(
+            token_limit * ESTIMATED_TOKEN_LIMIT_RATIO
+        ), f"Batch over the scaled token limit: {batch_tokens}"
+        batched_texts.extend(batch_texts)
+
+    assert batched_texts == texts, "Texts lost or reordered across batches"
+
+
+def test_poller_retries_transient_errors() -> None:
+    """Test that polling backs off on transient errors, and fails on other errors."""
+    from openai import APIConnectionError, APIStatusError
+
+    from apps.rag.batch_utils import BATCH_POLL_MAX_FAILURES, _BatchPoller
+
+    connection_error = APIConnectionError(request=MagicMock())
+    server_error = APIStatusError(
+        "Service Unavailable", response=MagicMock(status_code=503), body=None
+    )
+    client_error = APIStatusError(
+        "Bad Request", response=MagicMock(status_code=400), body=None
+    )
+    batch = MockBatch(
+        id="mock_batch_id_0",
+        input_file_id="mock_file_id_0",
+        status="completed",
+        output_file_id="mock_output_file_id_0",
+    )
+    with patch(f"{module_name}._get_poll_interval", return_value=0.0):
+        mock_client = MagicMock()
+        mock_client.batches.list.side_effect = [
+            connection_error,
+            server_error,
+            MagicMock(data=[batch]),
+        ]
+        assert _BatchPoller(mock_client, 0).wait(batch.id) == batch
+
+        for side_effect, num_polls in (
+            ([client_error], 1),
+            ([connection_error] * BATCH_POLL_MAX_FAILURES, BATCH_POLL_MAX_FAILURES),
+        ):
+            mock_client = MagicMock()
+            mock_client.batches.list.side_effect = side_effect
+            with pytest.raises(type(side_effect[0])):
+                _BatchPoller(mock_client, 0).wait(batch.id)
+            assert mock_client.batches.list.call_count == num_polls
+
+
+def test_async_embeddings_keep_order_across_batches() -> None:
+    """Test that batches completing out of order still yield embeddings in input order."""
+    from apps.rag.batch_utils import _request_async_embedding
+
+    texts: List[str] = [str(idx) for idx in range(NUM_TEXTS // 8)]
+    mock_client = MockOutOfOrderBatchClient()
+    with (
+        patch(f"{module_name}.OpenAI", return_value=mock_client),
+        patch(f"{module_name}._get_poll_interval", return_value=0.001),
+        patch(f"{module_name}.MAX_CHUNK_SIZE_PER_REQUEST", 16),
+    ):
+        result: List[List[float]] = _request_async_embedding(
+            "mock-model",
+            texts,
+            "mock_api_key",
+            "https://batch.mock.test/v1",
+            "24h",
+            0,
+            token_limit=800,
+            max_concurrent_batches=4,
+        )
+
+    assert len(mock_client.mock_batches) > 4, "Expected several rounds of batches"
+    assert result == [[float(text)] for text in texts], "Embeddings out of order"
+
+
+def test_async_embeddings_cancel_batches_on_failure() -> None:
+    """Test that a failed batch fails the job, and cancels the batch jobs in flight."""
+    from tenacity import RetryError, wait_none
+
+    from apps.rag.batch_utils import (
+        TENAICITY_RETRY_ATTEMPTS,
+        _process_one_batch,
+        _request_async_embedding,
+    )
+
+    texts: List[str] = [str(idx) for idx in range(NUM_TEXTS // 8)]
+    mock_client = MockOutOfOrderBatchClient(failed_batch_indices={1})
+    with (
+        patch(f"{module_name}.OpenAI", return_value=mock_client),
+        patch(f"{module_name}._get_poll_interval", return_value=0.001),
+        patch.object(_process_one_batch.retry, "wait", wait_none()),
+        pytest.raises(RetryError),
+    ):
+        _request_async_embedding(
+            "mock-model",
+            texts,
+            "mock_api_key",
+            "https://batch.mock.test/v1",
+            "24h",
+            0,
+            token_limit=800,
+            max_concurrent_batches=4,
+        )
+
+    statuses: List[str] = [batch.status for batch in mock_client.mock_batches.values()]
+    assert statuses.count("failed") == TENAICITY_RETRY_ATTEMPTS, "Expected retries"
+    assert (
+        statuses.count("cancelled") == 3
+    ), "Expected the other batches to be cancelled"
+    assert "in_progress" not in statuses, "Expected no batch to be left running"
+
+
+def test_split_by_tokens_edge_cases() -> None:
+    """Test empty input, oversized texts, and the text cap binding before the token cap."""
+    from apps.rag.batch_utils import _split_by_tokens
+
+    def split(token_counts: List[int], *args: int) -> List[tuple[int, int]]:
+        return list(_split_by_tokens(np.array(token_counts, dtype=np.int64), *args))
+
+    assert split([], 10) == [], "Expected no ranges for no texts"
+    assert split([3, 20, 3, 3], 10) == [
+        (0, 1),
+        (1, 2),
+        (2, 4),
+    ], "Expected the oversized text to get a range of its own"
+    assert split([1] * 5, 10, 2) == [
+        (0, 2),
+        (2, 4),
+        (4, 5),
+    ], "Expected the text cap to split before the token cap"
+
+
+def test_split_by_tokens_matches_greedy_loop() -> None:
+    """Test that the binary search splits texts exactly like a greedy loop."""
+    from apps.rag.batch_utils import _split_by_tokens
+
+    def greedy_split(
+        token_counts: List[int], max_tokens: int, max_texts: Optional[int]
+    ) -> List[tuple[int, int]]:
+        ranges: List[tuple[int, int]] = []
+        start: int = 0
+        current_tokens: int = 0
+        for idx, tokens in enumerate(token_counts):
+            if idx > start and (
+                (max_texts is not None and idx - start >= max_texts)
+                or current_tokens + tokens > max_tokens
+            ):
+                ranges.append((start, idx))
+                start = idx
+                current_tokens = 0
+            current_tokens += tokens
+        if start < len(token_counts):
+            ranges.append((start, len(token_counts)))
+        return ranges
+
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        token_counts: List[int] = rng.integers(0, 50, rng.integers(0, 200)).tolist()
+        max_tokens: int = int(rng.integers(1, 200))
+        max_texts: Optional[int] = (
+            int(rng.integers(1, 20)) if rng.random() < 0.5 else None
+        )
+        assert list(
+            _split_by_tokens(
+                np.array(token_counts, dtype=np.int64), max_tokens, max_texts
+            )
+        ) == greedy_split(token_counts, max_tokens, max_texts)
+
+
+def test_batch_file_escapes_lone_surrogates() -> None:
+    """Test that texts with lone surrogates are still written to the batch file."""
+    from apps.rag.batch_utils import _estimate_token_count, _write_batch_file
+
+    texts: List[str] = ["before", "a\ud800b", "after"]
+    batch_file = _write_batch_file(
+        texts, _estimate_token_count(texts), "mock-model", "uuid", 0, chunk_size=1
+    )
+    requests: List[MockBatchRequest] = list(
+        map(json.loads, batch_file.read().split(b"\n"))
+    )
+    assert [request["body"]["input"] for request in requests] == [
+        [text] for text in texts
+    ], "Expected every text to round-trip"